@@ -583,7 +583,7 @@ def vertex_to_element(upper_bound_vertex: int,
                                                                   element_to_vertex_ptr,
                                                                   indices_ptr)
     #util.print_array_info('indices', indices)
-    size = indices[-1]
+    size = indices[indices.shape[0] - 1]  # last entry; no negative indexing, wraparound is off module-wide
     vertices_to_elements = util.empty_aligned(size, dtype=numpy.uint32)
     vertices_to_elements_ptr = <cutil.uint32_ptr> vertices_to_elements.data
 
@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 
 from setuptools import setup
+from Cython.Build import cythonize
 from Cython.Distutils import Extension
-from Cython.Distutils.build_ext import build_ext
+try:
+    # the cythonize-based build_ext (Cython 0.29+) forwards the --parallel/-j option to
+    # cythonize(nthreads=...) when translating .pyx sources; the C/C++ compiles themselves
+    # still go through the distutils path, parallelized by BuildExtensions below
+    from Cython.Distutils.build_ext import new_build_ext as build_ext
+except ImportError:
+    from Cython.Distutils.build_ext import build_ext
 # from setuptools.extension import Extension
 # from setuptools.command.build_ext import build_ext
-import pkg_resources
-import distutils.ccompiler
+from setuptools.command.build_clib import build_clib
 import distutils.sysconfig
 import glob
+import multiprocessing.pool
 import os
+import shutil
 import sys
-import multiprocessing.pool
 
 
 long_description = """
@@ -28,25 +35,62 @@ for key, value in cfg_vars.items():
 
 class BuildExtensions(build_ext):
     """
-    Subclass setuptools build_ext command. Does the following
-    1) it makes sure numpy is available
-    2) it injects numpy's core/include directory in the include_dirs parameter of all extensions
-    3) it runs the original build_ext command
+    Subclass the Cython build_ext command. Does the following
+    1) it runs build_clib first when static libraries are declared; the stock command only
+       adds build_clib's output directory to the link path and never runs the command (it
+       is a sub-command of the top-level build only), so a plain 'setup.py build_ext -i'
+       (the Makefile's build target) would fail to find libaffect_connect
+    2) it compiles the objects within each extension concurrently, honoring --parallel/-j;
+       the stock parallel support submits one task per extension, which leaves the many C
+       files of a single extension (e.g. affect.exodus) compiling one at a time
     """
 
     def run(self):
-        # According to https://pip.pypa.io/en/stable/reference/pip_install.html#installation-order
-        # at this point we can be sure pip has already installed numpy
-        from numpy import get_include
-        numpy_includes = get_include()
-        # Alternatively
-        # numpy_includes = pkg_resources.resource_filename('numpy', 'core/include')
-        for ext in self.extensions:
-            if hasattr(ext, 'include_dirs'):
-                if numpy_includes not in ext.include_dirs:
-                    ext.include_dirs.append(numpy_includes)
+        if self.distribution.has_c_libraries():
+            self.run_command('build_clib')
         build_ext.run(self)
 
+    def build_extensions(self):
+        workers = int(self.parallel or 0)
+        if workers > 1:
+            # replace compile on this command's compiler instance only, unlike the old
+            # process-global monkey-patch of distutils.ccompiler.CCompiler.compile
+            compiler = self.compiler
+
+            def parallel_compile(sources, output_dir=None, macros=None, include_dirs=None, debug=0,
+                                 extra_preargs=None, extra_postargs=None, depends=None):
+                # the setup lines are copied from distutils.ccompiler.CCompiler.compile directly
+                macros, objects, extra_postargs, pp_opts, build = compiler._setup_compile(
+                    output_dir, macros, include_dirs, sources, depends, extra_postargs)
+                cc_args = compiler._get_cc_args(pp_opts, debug, extra_preargs)
+
+                def _single_compile(obj):
+                    try:
+                        src, ext = build[obj]
+                    except KeyError:
+                        return
+                    compiler._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+                with multiprocessing.pool.ThreadPool(workers) as pool:
+                    pool.map(_single_compile, objects)
+                return objects
+
+            compiler.compile = parallel_compile
+        build_ext.build_extensions(self)
+
+
+class NumpyIncludePath:
+    """
+    Lazy stand-in for numpy's include directory. The compiler only formats include paths
+    into -I options once it actually runs, by which point numpy is installed (it is in
+    setup_requires); deferring the import until __str__ keeps metadata-only commands like
+    'setup.py egg_info' working in environments that do not have numpy yet.
+    """
+
+    def __str__(self):
+        from numpy import get_include
+        return get_include()
+
 
 def get_netcdf_include():
     # setup and distutils compiler does not find the base include path in anaconda installs
@@ -59,16 +103,54 @@ def get_netcdf_include():
                 return root
     raise RuntimeError('Error: setup.py could not find {}'.format(include))
 
+def wrap_ccache(compiler):
+    # prefix the compiler command with ccache, when installed, so unchanged translation units
+    # are replayed from the compiler cache on rebuilds (opt out with USE_CCACHE=0)
+    if os.environ.get('USE_CCACHE', '1') == '0' or shutil.which('ccache') is None:
+        return compiler
+    return 'ccache ' + compiler
+
+
 def get_cpu_options(platform):
-    # return a clang/gcc compile flag with the highest level of sse, avx instructions supported on the compile CPU
-    flag = ['']
-    if platform == 'darwin':
-        return ['-march=native']
-    elif platform.startswith('linux'):
+    # return a clang/gcc compile flag with the highest level of sse, avx instructions supported on the compile CPU;
+    # AFFECT_NATIVE=0 (e.g. when building redistributable wheels) targets the portable x86-64-v3
+    # baseline (AVX2+FMA) instead of the compile CPU
+    if platform == 'darwin' or platform.startswith('linux'):
+        if os.environ.get('AFFECT_NATIVE', '1') == '0':
+            return ['-march=x86-64-v3']
         return ['-march=native']
     else:
         raise Exception(f'Unknown platform ({platform}')
-    return flag
+
+
+# optimization level for the numeric C/C++ kernels; do not rely on whatever -O level the
+# python interpreter was configured with, and let the auto-vectorizer fill the SIMD lanes
+optimize_compile_args = ['-O3', '-ffast-math', '-funroll-loops']
+
+
+def get_pgo_options():
+    # two-phase profile-guided optimization:
+    #   AFFECT_PGO=generate python setup.py build_ext -i   (instrumented build)
+    #   py.test affect/tests                               (or another representative workload)
+    #   AFFECT_PGO=use python setup.py build_ext -i        (optimized rebuild from the profiles)
+    # profiles are written to/read from AFFECT_PGO_DIR (default build/pgo)
+    pgo = os.environ.get('AFFECT_PGO', '')
+    profile_dir = os.environ.get('AFFECT_PGO_DIR', os.path.join('build', 'pgo'))
+    if pgo == 'generate':
+        return ['-fprofile-generate={}'.format(profile_dir)]
+    elif pgo == 'use':
+        return ['-fprofile-use={}'.format(profile_dir), '-fprofile-correction']
+    elif pgo:
+        raise RuntimeError('Error: AFFECT_PGO must be "generate" or "use", not {}'.format(pgo))
+    return []
+
+
+pgo_options = get_pgo_options()
+
+# link-time optimization fuses the C/C++ translation units with the Cython module at link
+# time, allowing cross-file inlining of the small connectivity kernels; opt in with
+# AFFECT_LTO=1 (e.g. for release builds) so ordinary edit/rebuild cycles keep fast links
+lto_options = ['-flto=auto'] if os.environ.get('AFFECT_LTO', '0') == '1' else []
 
 
 # platform specific header and library directories
@@ -76,6 +158,7 @@ other_include = ''
 other_library = ''
 other_link_args = ''
 other_compile_args = ''
+openmp_libs = []
 
 util_compile_args = ''
 exodus_compile_args = ''
@@ -83,36 +166,42 @@ connect_compile_args = ''
 arithmetic_compile_args = ''
 
 util_source_files = ['affect/util.pyx']
-util_source_files += glob.glob('affect/src/util/*.cpp')
+util_source_files += sorted(glob.glob('affect/src/util/*.cpp'))
 util_include = ['affect/src/util', 'affect/src']
 
 arithmetic_source_files = ['affect/arithmetic.pyx']
-arithmetic_source_files += glob.glob('affect/src/arithmetic/*.cpp')
+arithmetic_source_files += sorted(glob.glob('affect/src/arithmetic/*.cpp'))
 arithmetic_include = ['affect/src/arithmetic', 'affect/src']
 
+# the connect C++ kernels are prebuilt into a static library (see static_libraries below)
+# so the affect.connect extension itself is just the thin Cython wrapper
 connect_source_files = ['affect/connect.pyx']
-connect_source_files += glob.glob('affect/src/connect/*.cpp')
+connect_library_sources = sorted(glob.glob('affect/src/connect/*.cpp'))
 connect_include = ['affect/src/connect', 'affect/src']
 
 dynamics_source_files = ['affect/dynamics.pyx']
 
 exodus_source_files = ['affect/exodus.pyx']
-exodus_source_files += glob.glob('affect/src/exodus/*.c')
+exodus_source_files += sorted(glob.glob('affect/src/exodus/*.c'))
 exodus_include = ['affect/src/exodus']
 
+numpy_include = [NumpyIncludePath()]
+
 python_base = sys.prefix
 _platform = sys.platform
 
 if _platform == 'linux' or _platform == 'linux2':
-    os.environ['CC'] = 'gcc'
-    os.environ['CXX'] = 'g++'
+    os.environ['CC'] = wrap_ccache('gcc')
+    os.environ['CXX'] = wrap_ccache('g++')
     other_include = []
     other_library = []  # ['/usr/local/opt/llvm/lib']  # location of libiomp5 (however, it may be in anaconda)
-    other_link_args = ['-fopenmp']  # ['-mmacosx-version-min=10.11']
+    openmp_libs = []  # gcc's -fopenmp on the link line pulls in libgomp itself
+    other_link_args = ['-fopenmp'] + pgo_options + lto_options
     exodus_include.append(get_netcdf_include())
 
     other_compile_args = ['-fopenmp']
     other_compile_args += get_cpu_options(_platform)
+    other_compile_args += optimize_compile_args + pgo_options + lto_options
     exodus_compile_args = ['-Dexodus_EXPORTS', '-std=c11', '-Wno-sign-compare', '-Wno-uninitialized']
     connect_compile_args = ['-std=c++14', '-Wno-deprecated', '-Wno-unused-variable', '-Wno-uninitialized']
     arithmetic_compile_args = ['-std=c++14', '-Wno-deprecated', '-Wno-unused-variable', '-Wno-uninitialized']
@@ -120,8 +209,11 @@ if _platform == 'linux' or _platform == 'linux2':
 
 elif _platform == 'darwin':
 
-    other_library = ['/usr/local/opt/llvm/lib']  # location of libiomp5 (however, it may be in anaconda)
-    other_link_args = ['-mmacosx-version-min=10.11']
+    # location of libiomp5 from brew's llvm (however, it may be in anaconda, in which case
+    # the linker finds it on the default search path and no extra -L directory is needed)
+    other_library = [d for d in ['/usr/local/opt/llvm/lib'] if os.path.isdir(d)]
+    openmp_libs = ['iomp5']  # brew llvm / anaconda supply Intel's OpenMP runtime
+    other_link_args = ['-mmacosx-version-min=10.11'] + pgo_options + lto_options
     other_include = []
 
     # -fslp-vectorize-aggressive
@@ -130,14 +222,15 @@ elif _platform == 'darwin':
     #                       '-mavx2', '-fslp-vectorize-aggressive']
     other_compile_args = ['-mmacosx-version-min=10.11', '-fopenmp']
     other_compile_args += get_cpu_options(_platform)
+    other_compile_args += optimize_compile_args + pgo_options + lto_options
     exodus_compile_args = ['-Dexodus_EXPORTS', '-Wno-unused-function', '-Wno-sometimes-uninitialized',
                            '-Wno-unreachable-code', '-Wno-sign-compare']
     connect_compile_args = ['-std=c++14', '-Wno-unused-function', '-Wno-unused-variable', '-Wno-deprecated']
     arithmetic_compile_args = ['-std=c++14', '-Wno-unused-function', '-Wno-unused-variable', '-Wno-deprecated']
     util_compile_args = ['-std=c++14', '-Wno-unused-function']
 
-    os.environ['CC'] = 'gcc-7'
-    os.environ['CXX'] = 'g++-7'
+    os.environ['CC'] = wrap_ccache('gcc-7')
+    os.environ['CXX'] = wrap_ccache('g++-7')
 
     # Clang Prerequisites:
     #   install the Xcode and command line tools:
@@ -165,24 +258,36 @@ elif _platform == 'darwin':
 
 
 elif _platform == 'win32':
-    os.environ['CC'] = 'gcc'
-    os.environ['CXX'] = 'gcc'
+    os.environ['CC'] = wrap_ccache('gcc')
+    os.environ['CXX'] = wrap_ccache('gcc')
+    other_include = []
+    other_library = []
+    # mingw gcc: enable the OpenMP pragmas in the kernels, same as the other platforms;
+    # there is no libiomp5 here, -fopenmp links libgomp itself
+    openmp_libs = []
+    other_link_args = ['-fopenmp'] + pgo_options + lto_options
+    other_compile_args = ['-fopenmp']
+    other_compile_args += optimize_compile_args + pgo_options + lto_options
+    exodus_compile_args = ['-Dexodus_EXPORTS', '-std=c11', '-Wno-sign-compare', '-Wno-uninitialized']
+    connect_compile_args = ['-std=c++14', '-Wno-deprecated', '-Wno-unused-variable', '-Wno-uninitialized']
+    arithmetic_compile_args = ['-std=c++14', '-Wno-deprecated', '-Wno-unused-variable', '-Wno-uninitialized']
+    util_compile_args = ['-std=c++14', '-Wno-unused-function']
 
 
 extensions = [
     Extension('affect.exodus',
               sources=exodus_source_files,
-              include_dirs=other_include + exodus_include,
-              libraries=['iomp5', 'netcdf'],
+              include_dirs=other_include + exodus_include + numpy_include,
+              libraries=openmp_libs + ['netcdf'],
               library_dirs=other_library,
               extra_compile_args=other_compile_args + exodus_compile_args,
               extra_link_args=other_link_args,
               language='c',
               ),
     Extension('affect.connect',
-              include_dirs=other_include + connect_include,
+              include_dirs=other_include + connect_include + numpy_include,
               sources=connect_source_files,
-              libraries=['iomp5'],
+              libraries=['affect_connect'] + openmp_libs,
               library_dirs=other_library,
               extra_compile_args=other_compile_args + connect_compile_args,
               extra_link_args=other_link_args,
@@ -190,9 +295,9 @@ extensions = [
               # undef_macros=['NDEBUG']  # enable assert(), etc.
               ),
     Extension('affect.arithmetic',
-              include_dirs=other_include + arithmetic_include,
+              include_dirs=other_include + arithmetic_include + numpy_include,
               sources=arithmetic_source_files,
-              libraries=['iomp5'],  # 'tbb'],
+              libraries=openmp_libs,  # + ['tbb'],
               library_dirs=other_library,
               extra_compile_args=other_compile_args + arithmetic_compile_args,
               extra_link_args=other_link_args,
@@ -201,13 +306,14 @@ extensions = [
               ),
     Extension('affect.dynamics',
               sources=dynamics_source_files,
+              include_dirs=numpy_include,
               library_dirs=other_library,
               extra_compile_args=other_compile_args,
               extra_link_args=other_link_args,
               language='c',
               ),
     Extension('affect.util',
-              include_dirs=other_include + util_include,
+              include_dirs=other_include + util_include + numpy_include,
               sources=util_source_files,
               library_dirs=other_library,
               extra_compile_args=other_compile_args+util_compile_args,
@@ -217,71 +323,67 @@ extensions = [
               ),
 ]
 
+# prebuild the connect C++ kernels once as a static library; BuildExtensions runs the
+# build_clib command first and links the archive into affect.connect, so touching
+# connect.pyx no longer recompiles the kernel translation units
+static_libraries = [
+    ('affect_connect', {'sources': connect_library_sources,
+                        'include_dirs': other_include + connect_include,
+                        'cflags': other_compile_args + connect_compile_args}),
+]
+
 #
 # global cython directives
 #
-for e in extensions:
-    e.cython_directives = {'embedsignature': True}
-
-    # build with support coverage or profiling using
-    # "python setup.py --linetrace build_ext -i"
-    if '--linetrace' in sys.argv:
-        e.define_macros = [('CYTHON_TRACE_NOGIL', '1')]
-        e.cython_directives = {'linetrace': True, 'binding': True, 'profile': True, 'embedsignature': True}
+# default off the per-access safety checks the hot loops already disable one function at a
+# time with @cython.boundscheck(False) etc., so the remaining loops compile to plain C too
+cython_directives = {'embedsignature': True, 'boundscheck': False, 'wraparound': False,
+                     'cdivision': True, 'initializedcheck': False}
 
+# build with support coverage or profiling using
+# "python setup.py --linetrace build_ext -i"
 if '--linetrace' in sys.argv:
     sys.argv.remove('--linetrace')
+    cython_directives.update({'linetrace': True, 'binding': True, 'profile': True})
+    for e in extensions:
+        e.define_macros = [('CYTHON_TRACE_NOGIL', '1')]
 
-NUMBER_PARALLEL_COMPILES = 16
-
-def parallel_c_compile(self, sources, output_dir=None, macros=None, include_dirs=None, debug=0, extra_preargs=None,
-                       extra_postargs=None, depends=None):
-    """
-    Enable parallel compiles of C/C++ during development. A monkey-patch of the distutils.ccompiler.
-    """
-    # those lines are copied from distutils.ccompiler.CCompiler directly
-    macros, objects, extra_postargs, pp_opts, build = self._setup_compile(output_dir, macros, include_dirs, sources,
-                                                                          depends, extra_postargs)
-    cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
-
-    def _single_compile(obj):
-        try:
-            src, ext = build[obj]
-        except KeyError:
-            return
-        self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
-
-    # convert to list, imap is evaluated on-demand
-    list(multiprocessing.pool.ThreadPool(NUMBER_PARALLEL_COMPILES).imap(_single_compile, objects))
-    return objects
-
+# translate the .pyx sources to C/C++ concurrently, one worker per translation unit
+# (override the worker count with the PARALLEL_LEVEL environment variable, e.g. in CI)
+cython_nthreads = int(os.environ.get('PARALLEL_LEVEL', os.cpu_count() or 1))
 
-# monkey patch compile to enable parallel compile
-distutils.ccompiler.CCompiler.compile = parallel_c_compile
+# default number of concurrent C/C++ compile jobs, passed to setup() as the build_ext
+# --parallel option; the command line (build_ext -j N) or MAX_JOBS still override it
+number_parallel_compiles = int(os.environ.get('MAX_JOBS', os.cpu_count() or 1))
 
 install_requires = ['cython >= 0.24.1', 'hdf4 >= 4.2.12', 'hdf5 >= 1.8.17', 'netcdf4 >= 1.2.4', 'numexpr >= 2.6.1',
                     'numpy >= 1.11.1']
 
-setup(
-    name='affect',
-    description='Affect - Processing Computational Simulations',
-    long_description=long_description,
-    license='MIT',
-    version='0.1',
-    author='Kevin Copps',
-    author_email='kdcopps@sandia.gov',
-    maintainer='Kevin Copps',
-    maintainer_email='kdcopps@sandia.gov',
-    url='https://github.com/kdcopps/affect',
-    packages=['affect'],
-    classifiers=['Programming Language :: Python :: 3', ],
-    setup_requires=['setuptools>=18.0', 'numpy', 'cython', 'netcdf4', 'pytest-runner'],
-    install_requires=install_requires,
-    tests_require=['pytest'],
-    zip_safe=False,
-    cmdclass={'build_ext': BuildExtensions},  # use our own subclass
-    ext_modules=extensions
-)
+# cythonize's nthreads pool and the build itself must not run when child processes
+# re-import this module on spawn-start platforms (win32, macOS on python 3.8+)
+if __name__ == '__main__':
+    setup(
+        name='affect',
+        description='Affect - Processing Computational Simulations',
+        long_description=long_description,
+        license='MIT',
+        version='0.1',
+        author='Kevin Copps',
+        author_email='kdcopps@sandia.gov',
+        maintainer='Kevin Copps',
+        maintainer_email='kdcopps@sandia.gov',
+        url='https://github.com/kdcopps/affect',
+        packages=['affect'],
+        classifiers=['Programming Language :: Python :: 3', ],
+        setup_requires=['setuptools>=18.0', 'numpy', 'cython', 'netcdf4', 'pytest-runner'],
+        install_requires=install_requires,
+        tests_require=['pytest'],
+        zip_safe=False,
+        cmdclass={'build_ext': BuildExtensions, 'build_clib': build_clib},
+        options={'build_ext': {'parallel': number_parallel_compiles}},
+        libraries=static_libraries,
+        ext_modules=cythonize(extensions, nthreads=cython_nthreads, compiler_directives=cython_directives)
+    )
 
 # alternatively
 # cmdclass={'build_ext': Cython.Build.build_ext},